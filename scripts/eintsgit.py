@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
 
+import contextlib
+import errno
 import subprocess
 import os
 import os.path
 import sys
 import fcntl
 import getopt
-import datetime
+import time
+from pathlib import Path
 
 # Eints authentification
 eints_login_file = "user.cfg"
@@ -24,6 +27,9 @@ git_remote_branch = git_remote + "/" + git_branch
 lang_sync_command = "./lang_sync"
 git_command = "git"
 
+# Timestamp format in messages
+time_format = "%Y-%m-%d %H:%M:%S"
+
 # Temporary files
 lock_file = "/tmp/eints.lock"
 msg_file = "/tmp/eints.msg"
@@ -55,6 +61,9 @@ class Settings:
             result.extend(["--unstable-lang-dir", self.unstable_lang_dir])
         return result
 
+    def get_lang_sync_command(self, *args):
+        return [lang_sync_command, *self.get_lang_sync_params(), *args]
+
     def get_working_dirs(self):
         result = [self.lang_dir]
         if self.unstable_lang_dir:
@@ -65,36 +74,63 @@ class Settings:
 class FileLock:
     """
     Inter-process lock mechanism via exclusive file locking.
+
+    POSIX record locks are used, as these also work on NFS. Such locks are owned by the process,
+    locking the same file again from the same process always succeeds.
+
+    @ivar timeout: Number of seconds to wait for the lock, or C{None} to fail immediately if it is taken.
+    @type timeout: C{int} or C{None}
     """
 
-    def __init__(self, name):
+    retry_interval = 1
+
+    def __init__(self, name, timeout=None):
         self.name = name
-        self.file = None
+        self.timeout = timeout
+        self.fd = None
 
     def __enter__(self):
-        assert self.file is None
+        assert self.fd is None
 
-        self.file = open(self.name, "a")
+        self.fd = os.open(self.name, os.O_CREAT | os.O_RDWR, 0o644)
         try:
-            fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self._acquire()
         except Exception:
-            self.file.close()
-            self.file = None
+            os.close(self.fd)
+            self.fd = None
             raise
-        self.file.truncate()
-        self.file.write("pid:{} date:{:%Y-%m-%d %H:%M:%S}\n".format(os.getpid(), datetime.datetime.now()))
-        self.file.flush()
+        os.ftruncate(self.fd, 0)
+        os.write(self.fd, "pid:{} date:{}\n".format(os.getpid(), time.strftime(time_format)).encode())
 
         return self
 
+    def _acquire(self):
+        """
+        Lock the file, polling until the timeout expires if another process holds it.
+        """
+
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except OSError as err:
+                if err.errno not in (errno.EACCES, errno.EAGAIN):
+                    raise
+                if self.timeout is None or time.monotonic() >= deadline:
+                    raise
+            time.sleep(self.retry_interval)
+
     def __exit__(self, exc_type, exc_val, exc_tb):
-        assert self.file is not None
+        assert self.fd is not None
 
-        os.remove(self.name)
-        fcntl.flock(self.file, fcntl.LOCK_UN)
-        self.file.close()
+        # The lock file is left in place. Removing it would allow a waiting process to lock
+        # the unlinked inode while a new one creates and locks a fresh file at the same path.
+        fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
 
-        self.file = None
+        self.fd = None
 
         return False
 
@@ -107,7 +143,35 @@ def print_info(msg):
     @type  msg: C{str}
     """
 
-    print("[{:%Y-%m-%d %H:%M:%S}] {}".format(datetime.datetime.now(), msg))
+    print("[{}] {}".format(time.strftime(time_format), msg))
+
+
+def command_lines(args):
+    """
+    Run a command, and yield its output line by line while it is running.
+    Closing the generator early terminates the command.
+
+    @param args: Command and its arguments.
+    @type  args: C{list} of C{str}
+
+    @return: Output lines, without line ending.
+    @rtype:  C{iterator} of C{str}
+    """
+
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, universal_newlines=True)
+    finished = False
+    try:
+        for line in proc.stdout:
+            yield line.rstrip("\n")
+        finished = True
+    finally:
+        if not finished:
+            proc.terminate()
+        proc.stdout.close()
+        retcode = proc.wait()
+
+    if retcode:
+        raise subprocess.CalledProcessError(retcode, args)
 
 
 def git_status(settings):
@@ -125,36 +189,36 @@ def git_status(settings):
     @rtype:  C{bool}
     """
 
-    msg = subprocess.check_output(
-        [git_command, "status", "-s", *settings.get_working_dirs()],
-        universal_newlines=True,
-    )
-    return msg.strip() != ""
+    status_cmd = [git_command, "status", "--porcelain", *settings.get_working_dirs()]
+    with contextlib.closing(command_lines(status_cmd)) as lines:
+        return any(lines)
 
 
-def git_pull(settings):
+def git_pull(settings, check_changes=True):
     """
     Update working copy, and revert all modifications.
 
-    @return: Whether files were updated.
+    @param check_changes: Find out whether language files were updated.
+    @type  check_changes: C{bool}
+
+    @return: Whether files were updated, or C{False} if not checked.
     @rtype:  C{bool}
     """
 
     subprocess.check_call([git_command, "fetch", git_remote])
-    subprocess.check_call([git_command, "clean", "-f", os.environ.get("GIT_WORK_TREE")])
-    changes = subprocess.check_output(
-        [git_command, "diff", "--name-only", "HEAD.." + git_remote_branch],
-        universal_newlines=True,
-    )
-    subprocess.check_call([git_command, "reset", "--hard", git_remote_branch])
+    subprocess.check_call([git_command, "clean", "-f", os.environ.get("GIT_WORK_TREE")], stdout=subprocess.DEVNULL)
 
-    for line in changes.splitlines():
-        if line.startswith(settings.lang_dir) >= 0:
-            return True
-        if settings.lang_dir and line.startswith(settings.lang_dir) >= 0:
-            return True
+    has_changes = False
+    if check_changes:
+        # Let git compare only the language directories, the exit code tells whether they differ.
+        diff_cmd = [git_command, "diff", "--quiet", "HEAD.." + git_remote_branch, "--", *settings.get_working_dirs()]
+        retcode = subprocess.call(diff_cmd)
+        if retcode not in (0, 1):
+            raise subprocess.CalledProcessError(retcode, diff_cmd)
+        has_changes = retcode == 1
 
-    return False
+    subprocess.check_call([git_command, "reset", "--hard", git_remote_branch], stdout=subprocess.DEVNULL)
+    return has_changes
 
 
 def git_push(settings, msg_file, dry_run):
@@ -169,9 +233,12 @@ def git_push(settings, msg_file, dry_run):
     """
 
     subprocess.check_call([git_command, "add", *settings.get_working_dirs()])
-    subprocess.check_call([git_command, "commit", "--author", commit_user, "-F", msg_file])
+    subprocess.check_call(
+        [git_command, "commit", "--author", commit_user, "-F", msg_file],
+        stdout=subprocess.DEVNULL,
+    )
     if not dry_run:
-        subprocess.check_call([git_command, "push"])
+        subprocess.check_call([git_command, "push"], stdout=subprocess.DEVNULL)
 
 
 def eints_upload(settings):
@@ -179,36 +246,30 @@ def eints_upload(settings):
     Update base language and translations to Eints.
     """
 
-    subprocess.check_call(
-        [
-            lang_sync_command,
-            *settings.get_lang_sync_params(),
-            "upload-base",
-            "upload-translations",
-        ]
-    )
+    subprocess.check_call(settings.get_lang_sync_command("upload-base", "upload-translations"))
 
 
-def eints_download(settings, credits_file):
+def eints_upload_and_download(settings, credits_file):
     """
-    Download translations from Eints.
+    Update base language and translations to Eints, and download the merged translations.
 
-    @param credits_file: File for translator credits.
+    @param credits_file: File for translator credits, they are appended to the existing content.
     @type  credits_file: C{str}
     """
 
     subprocess.check_call(
-        [
-            lang_sync_command,
-            *settings.get_lang_sync_params(),
+        settings.get_lang_sync_command(
             "--credits",
             credits_file,
+            "--credits-append",
+            "upload-base",
+            "upload-translations",
             "download-translations",
-        ]
+        )
     )
 
 
-def update_eints_from_git(settings, force, pull):
+def update_eints_from_git(settings, force, pull, lock_timeout):
     """
     Perform the complete operation from syncing Eints from the repository.
 
@@ -217,9 +278,12 @@ def update_eints_from_git(settings, force, pull):
 
     @param pull: Pull from remote, or use working copy as-it.
     @type  pull: C{bool}
+
+    @param lock_timeout: Seconds to wait for another instance to finish, or C{None} to not wait.
+    @type  lock_timeout: C{int} or C{None}
     """
 
-    with FileLock(lock_file):
+    with FileLock(lock_file, lock_timeout):
         has_changes = False
         if pull:
             print_info("Check updates from git")
@@ -230,7 +294,7 @@ def update_eints_from_git(settings, force, pull):
         print_info("Done")
 
 
-def commit_eints_to_git(settings, dry_run, pull):
+def commit_eints_to_git(settings, dry_run, pull, lock_timeout):
     """
     Perform the complete operation from commit Eints changes to the repository.
 
@@ -239,28 +303,23 @@ def commit_eints_to_git(settings, dry_run, pull):
 
     @param pull: Pull from remote, or use working copy as-it.
     @type  pull: C{bool}
+
+    @param lock_timeout: Seconds to wait for another instance to finish, or C{None} to not wait.
+    @type  lock_timeout: C{int} or C{None}
     """
 
-    with FileLock(lock_file):
+    with FileLock(lock_file, lock_timeout):
         # Upload first in any case.
         if pull:
             print_info("Update from git")
-            git_pull(settings)
-        print_info("Upload/Merge translations")
-        eints_upload(settings)
+            git_pull(settings, check_changes=False)
 
-        print_info("Download translations")
-        eints_download(settings, msg_file)
+        print_info("Upload/Merge and download translations")
+        # Translator credits are appended to the commit message.
+        Path(msg_file).write_text(commit_message, encoding="utf-8")
+        eints_upload_and_download(settings, msg_file)
         if git_status(settings):
             print_info("Commit changes")
-            # Assemble commit messge
-            with open(msg_file, "r+", encoding="utf-8") as f:
-                cred = f.read()
-                f.seek(0)
-                f.truncate(0)
-                f.write(commit_message)
-                f.write(cred)
-
             git_push(settings, msg_file, dry_run)
         print_info("Done")
 
@@ -279,6 +338,7 @@ def run():
                 "force",
                 "pull",
                 "dry-run",
+                "lock-timeout=",
                 "base-url=",
                 "project=",
                 "lang-dir=",
@@ -292,9 +352,8 @@ def run():
         sys.exit(2)
 
     # Parse options
-    force = False
-    dry_run = False
-    pull = False
+    flags = {"--force": False, "--pull": False, "--dry-run": False}
+    lock_timeout = None
     settings = Settings()
 
     for opt, val in opts:
@@ -320,6 +379,9 @@ with <options>:
 --dry-run
     See individual operations below
 
+--lock-timeout=SECONDS
+    Wait up to SECONDS for another running eintsgit to finish, instead of failing immediately.
+
 --project
     Eints project identifier
 
@@ -354,16 +416,18 @@ commit-to-git
             )
             sys.exit(0)
 
-        if opt == "--force":
-            force = True
-            continue
-
-        if opt == "--pull":
-            pull = True
+        if opt in flags:
+            flags[opt] = True
             continue
 
-        if opt == "--dry-run":
-            dry_run = True
+        if opt == "--lock-timeout":
+            try:
+                lock_timeout = int(val)
+            except ValueError:
+                lock_timeout = -1
+            if lock_timeout < 0:
+                print("Invalid {} value: {}".format(opt, val))
+                sys.exit(2)
             continue
 
         key = opt[2:].replace("-", "_")
@@ -414,10 +478,10 @@ commit-to-git
 
     # Execute operations
     if do_update:
-        update_eints_from_git(settings, force, pull)
+        update_eints_from_git(settings, flags["--force"], flags["--pull"], lock_timeout)
 
     if do_commit:
-        commit_eints_to_git(settings, dry_run, pull)
+        commit_eints_to_git(settings, flags["--dry-run"], flags["--pull"], lock_timeout)
 
     sys.exit(0)
 
@@ -4,16 +4,27 @@ Root page.
 
 from ..bottle import (
     HTTPResponse,
+    request,
     route,
 )
 from ..protect import protected
 from ..utils import template
 
+# Rendered root page for anonymous users, it is the same for every such request.
+_anonymous_page = None
+
 
 @route("/", method="GET")
 @protected(["root", "-", "-"])
 def root(userauth):
-    return template("root", userauth=userauth)
+    global _anonymous_page
+
+    if userauth.is_auth or request.query.get("message", ""):
+        return template("root", userauth=userauth)
+
+    if _anonymous_page is None:
+        _anonymous_page = template("root", userauth=userauth)
+    return _anonymous_page
 
 
 @route("/robots.txt", method="GET")